@@ -1,305 +1,640 @@
-import os
-import re
-import json
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Literal, Dict
-from openai import OpenAI
-from dotenv import load_dotenv
-
-# Load environment variables from a .env file
-load_dotenv()
-
-# --- Configuration ---
-app = FastAPI(
-    title="Therapeutic Assistant",
-    description="A POC for a therapeutic chat usecases.",
-    version="1.0.0"
-)
-
-# Allow all origins for CORS (for simple POC)
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# --- OpenAI Client Setup ---
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    print("Warning: OPENAI_API_KEY environment variable not set.")
-    
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# --- Safety Layer ---
-# Regex for emergency keywords (case-insensitive)
-EMERGENCY_PATTERN = re.compile(
-    r"\b(suicide|kill myself|want to die|chest pain|can't breathe|cant breathe|heart attack|trouble breathing|overdose|I am in danger|im in danger|die)\b",
-    re.IGNORECASE
-)
-
-# Canned emergency response (as a structured object)
-EMERGENCY_RESPONSE = {
-    "intent": "escalate",
-    "summary": "It sounds like you might be in immediate danger or experiencing a medical emergency. Please seek help right now.",
-    "actions": [
-        {
-            "type": "seek-professional",
-            "text": "Please contact your local emergency services immediately (for example, 911 or 999), or go to the nearest emergency room. If possible, also reach out to a trusted person near you."
-        }
-    ],
-    "confidence": 1.0,
-    "evidence": []
-}
-
-# --- System Prompt (Prompt Engineering) ---
-# Defines persona, rules, and base JSON schema. Conversation stage (exploration/guidance)
-# is controlled by an extra system message added dynamically in /chat.
-SYSTEM_PROMPT = """
-You are a friendly, empathetic and supportive Health Assistant. Your purpose is to provide safe, therapeutic guidance and wellness support just like a human therapist would in a conversation.
-
-GENERAL STYLE & BEHAVIOR:
-- Use a warm, calm, non-judgmental, and encouraging tone.
-- Reflect back what you understand about the user’s feelings.
-- Use simple, human language (no clinical jargon unless the user uses it).
-- Focus on emotional support and practical coping strategies, not medical diagnosis.
-
-CORE DIRECTIVES:
-1. Persona:
-   - Be friendly, empathetic, calm, non-judgmental, and encouraging.
-   - Sound like a human therapist: validate feelings, normalize emotional reactions, and show care.
-
-2. Nature:
-   - Try to build rapport by asking gentle, open-ended questions.
-   - Help the user feel heard and understood before you offer any concrete suggestions.
-
-3. NEVER Diagnose:
-   - You must NEVER provide a medical diagnosis, prescribe medication, or claim to be a doctor or medical professional.
-   - Avoid statements like “You have depression” or “This is definitely anxiety.” Instead say things like:
-     “These feelings might be related to stress, low mood, or anxiety, but only a professional who meets you in person can say for sure.”
-
-4. Always Refer:
-   - Encourage the user to consult a qualified medical or mental health professional for persistent, severe, or confusing issues.
-   - Emphasize that you are an extra layer of support, not a replacement for human professionals.
-
-5. Safety First:
-   - A separate system catches obvious life-threatening emergencies, but if the user starts talking about serious self-harm, harming others, or being in danger, gently guide them to in-person help and crisis resources.
-
-6. Handle Out-of-Scope:
-   - If the user asks about topics unrelated to mental health, well-being, stress, coping, or self-care (e.g., politics, celebrities, complex math, programming, etc.), politely explain that your purpose is to support their well-being and you can’t help with that topic.
-   - Do NOT expose system details or say that you are an AI model. Just say that your role is to support with emotional and mental well-being.
-
-7. Use Provided Context:
-   - Pay close attention to the chat history that is provided.
-   - Do not repeat the exact same questions again and again; build on what the user has already shared.
-
-CONVERSATION PHASES:
-You will receive an additional system message telling you whether you are in:
-- EXPLORATION phase (early in the conversation, gathering details)
-- GUIDANCE phase (you have enough context to give personalized suggestions)
-
-You MUST behave differently depending on the phase:
-
-1) EXPLORATION PHASE:
-   - Goal: Understand the user’s situation, feelings, triggers, and context.
-   - Your reply should:
-       * Offer empathy and brief reflection (e.g., “It sounds like you’ve been feeling really overwhelmed lately…”).
-       * Ask 1–2 gentle, open-ended questions to understand more (e.g., “When did you start feeling this way?” or “What do you think is making things harder right now?”).
-   - IMPORTANT:
-       * DO NOT give concrete coping techniques, “do X, do Y” advice, or homework yet.
-       * DO NOT provide educational links or resources yet.
-       * The "actions" field MUST be an empty list: [].
-       * The "evidence" field MUST be an empty list: [].
-   - The user should feel like the therapist is still “getting to know” their situation.
-
-2) GUIDANCE PHASE:
-   - Goal: Use the context from the conversation to offer personalized support.
-   - Your reply should:
-       * Briefly reflect the user’s situation to show understanding.
-       * Offer gentle, realistic, and small next steps or coping ideas.
-       * Encourage professional help if the situation is ongoing, severe, or complex.
-   - IMPORTANT:
-       * The "actions" list MUST contain 1–3 small, concrete steps the user can try (e.g., breathing exercise, journaling, reaching out to a friend, scheduling a professional appointment).
-       * The "evidence" list MUST contain exactly ONE resource item.
-         - "source" MUST be one of: "WHO", "NHS", "APA".
-         - "link" MUST be a real, relevant URL from one of these domains:
-             WHO: 'https://www.who.int/'
-             NHS: 'https://www.nhs.uk/'
-             APA: 'https://www.apa.org/'
-         - Choose a link that roughly matches the main topic (e.g., depression, anxiety, stress, sleep, mental health).
-
-OUTPUT FORMAT (STRICT JSON):
-You MUST output ONLY a JSON object with this structure and nothing else. No markdown, no backticks, no commentary outside JSON.
-
-{
-  "intent": "A short category of your response. Must be one of: ['self-care', 'refer', 'escalate', 'out-of-scope']",
-  "summary": "In EXPLORATION: an empathetic reflection plus 1–2 gentle, open questions. In GUIDANCE: a concise, one-paragraph reflection plus supportive, tailored guidance.",
-  "actions": [
-    {
-      "type": "The type of action. Must be one of: ['self-care', 'seek-professional', 'information']",
-      "text": "A concrete, actionable suggestion. For example: 'Try a 5-minute slow breathing exercise: inhale for 4 seconds, hold for 4, exhale for 6.' or 'Consider booking a session with a therapist to talk through these feelings.'"
-    }
-  ],
-  "confidence": "A float (0.0 to 1.0) representing your confidence in the appropriateness of your guidance. Use lower values when the situation is complex, vague, or long-term.",
-  "evidence": [
-    {
-      "title": "A short descriptive title for a helpful resource (e.g., 'Understanding Low Mood', 'Coping with Anxiety').",
-      "source": "Exactly one of: 'WHO', 'NHS', 'APA'.",
-      "link": "A single, relevant URL from WHO, NHS or APA websites."
-    }
-  ]
-}
-
-NOTES:
-- In EXPLORATION phase: "actions": [] and "evidence": [] MUST be empty lists.
-- In GUIDANCE phase: "actions" MUST have 1–3 items, and "evidence" MUST have exactly 1 item.
-- Keep the JSON valid at all times. Do not include comments inside JSON.
-"""
-
-# --- Pydantic Models (Data Validation) ---
-
-class ActionItem(BaseModel):
-    type: Literal['self-care', 'seek-professional', 'information']
-    text: str
-
-class EvidenceItem(BaseModel):
-    title: str
-    source: str
-    link: str
-
-class ChatResponse(BaseModel):
-    intent: Literal['self-care', 'refer', 'escalate', 'out-of-scope']
-    summary: str
-    actions: List[ActionItem]
-    confidence: float = Field(..., ge=0.0, le=1.0)
-    evidence: List[EvidenceItem]
-
-class ChatRequest(BaseModel):
-    message: str
-    history: List[Dict[str, str]] = []  # History of {"role": "user" | "assistant", "content": "..."}
-
-# --- Helpers ---
-
-def build_phase_instruction(user_turn_count: int) -> str:
-    """
-    Returns a system message that tells the model whether it is in
-    EXPLORATION or GUIDANCE phase and reinforces the correct behavior.
-    """
-    if user_turn_count <= 3:
-        phase = "EXPLORATION"
-        return f"""
-You are currently in the EXPLORATION phase of the conversation.
-- User messages so far (including current): {user_turn_count}.
-- DO NOT give concrete suggestions or techniques yet.
-- Focus on empathy and understanding.
-- Ask 1–2 gentle, open-ended questions to better understand what they are going through.
-- The 'actions' field in your JSON MUST be an empty list: [].
-- The 'evidence' field in your JSON MUST be an empty list: [].
-- 'intent' will usually be 'self-care' unless you need to 'refer' or 'escalate'.
-"""
-    else:
-        phase = "GUIDANCE"
-        return f"""
-You are now in the GUIDANCE phase of the conversation.
-- User messages so far (including current): {user_turn_count}.
-- You have enough context to offer personalized support.
-- Provide 1–3 concrete, realistic next steps in 'actions'.
-- Provide exactly ONE appropriate resource in 'evidence' (WHO, NHS, or APA).
-- Maintain empathy and validation while giving guidance.
-"""
-
-# --- API Endpoints ---
-
-@app.get("/", response_class=HTMLResponse)
-async def get_root(request: Request):
-    """Serves the main HTML chat interface."""
-    try:
-        with open("index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="index.html not found.")
-
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Handles the main chat logic with exploration → guidance behavior."""
-    
-    # 1. --- SAFETY LAYER ---
-    if EMERGENCY_PATTERN.search(request.message):
-        # Immediate emergency path: return the canned escalation response
-        return JSONResponse(content=EMERGENCY_RESPONSE)
-
-    # 2. --- Determine Conversation Phase ---
-    # Count user messages in history + this one
-    user_turns_in_history = sum(
-        1 for msg in request.history if msg.get("role") == "user"
-    )
-    user_turn_count = user_turns_in_history + 1  # include current message
-
-    phase_instruction = build_phase_instruction(user_turn_count)
-
-    # 3. --- Construct Prompt ---
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": phase_instruction},
-    ]
-
-    # Add chat history exactly as stored by the frontend
-    # (assistant messages are JSON strings, which is fine; treat as previous replies)
-    messages.extend(request.history)
-
-    # Add current user message
-    messages.append({"role": "user", "content": request.message})
-    
-    # 4. --- Call OpenAI API ---
-    if not client.api_key:
-        raise HTTPException(
-            status_code=500,
-            detail="OPENAI_API_KEY not configured on the server. Please set the environment variable."
-        )
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=0.7,
-            max_tokens=1024
-        )
-        
-        response_content = response.choices[0].message.content
-        
-        # 5. --- Parse and Validate Response ---
-        if response_content:
-            try:
-                # Parse JSON from the LLM
-                response_data = json.loads(response_content)
-
-                # Validate with Pydantic to enforce schema
-                validated_response = ChatResponse(**response_data)
-                return validated_response
-            
-            except json.JSONDecodeError:
-                raise HTTPException(status_code=500, detail="LLM returned invalid JSON.")
-            except Exception as e:
-                # Pydantic validation errors or other structural issues
-                raise HTTPException(status_code=500, detail=f"LLM response validation failed: {e}")
-        else:
-            raise HTTPException(status_code=500, detail="LLM returned an empty response.")
-
-    except Exception as e:
-        # Handle OpenAI API errors or other runtime issues
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-
-# --- Run the App (for local debugging) ---
-# if __name__ == "__main__":
-#     import uvicorn
-#     print("Starting FastAPI server...")
-#     print("To use the app, set your OPENAI_API_KEY environment variable.")
-#     print("Example: export OPENAI_API_KEY='your_key_here'")
-#     print("Then run: python main.py")
-#     print("Access the app at http://localhost:8000")
-#     uvicorn.run(app, host="0.0.0.0", port=8000)
+import os
+import re
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+
+import ahocorasick
+import cachetools
+import httpx
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from typing import List, Literal, Dict, Optional
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, OpenAIError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from dotenv import load_dotenv
+
+# Load environment variables from a .env file
+load_dotenv()
+
+# --- OpenAI Client Setup ---
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    print("Warning: OPENAI_API_KEY environment variable not set.")
+
+# --- Response Cache ---
+# Repeated prompts (common in dev and with short openers like "hi") skip the
+# OpenAI round-trip entirely. Entries are validated reply bytes keyed by the
+# phase, the current message, and the last few history turns; the TTL keeps
+# stale guidance from living more than an hour.
+_RESPONSE_CACHE: cachetools.TTLCache = cachetools.TTLCache(maxsize=2048, ttl=3600)
+
+def _response_cache_key(phase: str, message: str, history: List[Dict[str, str]]) -> bytes:
+    return hashlib.blake2b(
+        phase.encode() + b"|" + message.encode() + b"|" + orjson.dumps(history[-4:]),
+        digest_size=16
+    ).digest()
+
+# --- Request Batching ---
+# Concurrent /chat calls are funneled through one queue and drained in windows
+# of up to MAX_BATCH requests (or MAX_WAIT seconds). Prompts differ per user,
+# so the chat API cannot merge them into a single completion; the drainer
+# fires the window as one asyncio.gather burst over the shared connection pool
+# and demultiplexes results back to each caller's Future.
+MAX_BATCH = 8
+MAX_WAIT = 0.025  # seconds
+
+# Transient OpenAI failures (throttling, dropped connections, timeouts) are
+# retried with jittered exponential backoff instead of surfacing straight to
+# the client as a 500 — re-POSTing the whole history from the frontend would
+# only amplify the rate limit. Anything else still fails fast.
+_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError)
+
+@retry(
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _create_completion(client: AsyncOpenAI, **kwargs):
+    return await client.chat.completions.create(**kwargs)
+
+# Strong references to in-flight background tasks so they are not
+# garbage-collected mid-run; each task removes itself when done.
+_BACKGROUND_TASKS: set = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+async def _dispatch_batch(client: AsyncOpenAI, batch: list):
+    """Fires one collected window of completions and resolves each caller's Future."""
+    results = await asyncio.gather(
+        *(_create_completion(client, **kwargs) for _, kwargs in batch),
+        return_exceptions=True
+    )
+    for (future, _), result in zip(batch, results):
+        if future.cancelled():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def _batch_worker(client: AsyncOpenAI, queue: asyncio.Queue):
+    """Drains the completion queue in small windows and dispatches each window concurrently."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + MAX_WAIT
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Dispatch the window in its own task so draining resumes immediately:
+        # a slow (or retrying) window must only delay its own callers, never
+        # serialize the requests arriving behind it.
+        _spawn(_dispatch_batch(client, batch))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates one shared httpx.AsyncClient for the whole process so every
+    /chat call reuses warm TCP/TLS connections to OpenAI (HTTP/2
+    multiplexing, no per-request handshake), plus the batching queue and
+    its background drain task.
+    """
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=200),
+    ) as http_client:
+        app.state.openai = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+        app.state.batch_queue = asyncio.Queue()
+        worker = asyncio.create_task(_batch_worker(app.state.openai, app.state.batch_queue))
+        try:
+            yield
+        finally:
+            worker.cancel()
+
+# --- Configuration ---
+app = FastAPI(
+    title="Therapeutic Assistant",
+    description="A POC for a therapeutic chat usecases.",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# --- Rate Limiting ---
+# Per-client throttle sized below the OpenAI RPM budget. When running several
+# uvicorn workers, point RATE_LIMIT_STORAGE_URI at a shared Redis so the
+# workers cooperate on one bucket; the in-memory default is fine for a single
+# process.
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+)
+app.state.limiter = limiter
+
+def _rate_limit_handler(request: Request, exc: RateLimitExceeded):
+    print(f"Rate limit exceeded for {get_remote_address(request)}: {exc.detail}")
+    return _rate_limit_exceeded_handler(request, exc)
+
+app.add_exception_handler(RateLimitExceeded, _rate_limit_handler)
+
+# Allow all origins for CORS (for simple POC)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# --- Safety Layer ---
+# Emergency triggers are all literal phrases, so they are screened with an
+# Aho-Corasick automaton: one O(n) pass over the lowercased message with no
+# backtracking, and cost stays flat as the keyword list grows.
+EMERGENCY_KEYWORDS = (
+    "die",
+    "suicide",
+    "kill myself",
+    "want to die",
+    "overdose",
+    "chest pain",
+    "heart attack",
+    "can't breathe",
+    "cant breathe",
+    "trouble breathing",
+    "i'm in danger",
+    "im in danger",
+    "i am in danger",
+)
+
+_EMERGENCY_AUTOMATON = ahocorasick.Automaton()
+for _kw in EMERGENCY_KEYWORDS:
+    _EMERGENCY_AUTOMATON.add_word(_kw, _kw)
+_EMERGENCY_AUTOMATON.make_automaton()
+
+# Cheap pre-filter for the common no-emergency path: every phrase in
+# EMERGENCY_KEYWORDS contains at least one of these distinctive words, so a
+# message whose tokens miss the set can skip the automaton scan entirely.
+_EMERGENCY_TOKENS = frozenset(
+    {"die", "suicide", "kill", "overdose", "chest", "attack", "breathe", "breathing", "danger"}
+)
+_TOKEN_RE = re.compile(r"[a-z]+")
+
+def is_emergency(message: str) -> bool:
+    """
+    Scans a message for emergency keywords in a single pass. A match only
+    counts when it falls on word boundaries (so "die" does not fire inside
+    "diet" or "died").
+    """
+    lower = message.lower()
+    if _EMERGENCY_TOKENS.isdisjoint(_TOKEN_RE.findall(lower)):
+        return False
+    for end_index, keyword in _EMERGENCY_AUTOMATON.iter(lower):
+        start_index = end_index - len(keyword) + 1
+        if start_index > 0 and lower[start_index - 1].isalnum():
+            continue
+        if end_index + 1 < len(lower) and lower[end_index + 1].isalnum():
+            continue
+        return True
+    return False
+
+# Canned emergency response (as a structured object)
+EMERGENCY_RESPONSE = {
+    "intent": "escalate",
+    "summary": "It sounds like you might be in immediate danger or experiencing a medical emergency. Please seek help right now.",
+    "actions": [
+        {
+            "type": "seek-professional",
+            "text": "Please contact your local emergency services immediately (for example, 911 or 999), or go to the nearest emergency room. If possible, also reach out to a trusted person near you."
+        }
+    ],
+    "confidence": 1.0,
+    "evidence": []
+}
+
+# The emergency payload never changes, so serialize it once at import and
+# reuse the same prebuilt Response instead of re-encoding per hit.
+_EMERGENCY_RESPONSE_OBJ = Response(
+    content=orjson.dumps(EMERGENCY_RESPONSE),
+    media_type="application/json"
+)
+
+# --- System Prompt (Prompt Engineering) ---
+# Defines persona, rules, and base JSON schema. Conversation stage (exploration/guidance)
+# is controlled by an extra system message added dynamically in /chat.
+# Keep this prompt a byte-identical literal with no per-request interpolation:
+# OpenAI caches identical prompt prefixes server-side, so a stable leading
+# block cuts repeat input-token processing on every call.
+SYSTEM_PROMPT = """
+You are a friendly, empathetic and supportive Health Assistant. Your purpose is to provide safe, therapeutic guidance and wellness support just like a human therapist would in a conversation.
+
+GENERAL STYLE & BEHAVIOR:
+- Use a warm, calm, non-judgmental, and encouraging tone.
+- Reflect back what you understand about the user’s feelings.
+- Use simple, human language (no clinical jargon unless the user uses it).
+- Focus on emotional support and practical coping strategies, not medical diagnosis.
+
+CORE DIRECTIVES:
+1. Persona:
+   - Be friendly, empathetic, calm, non-judgmental, and encouraging.
+   - Sound like a human therapist: validate feelings, normalize emotional reactions, and show care.
+
+2. Nature:
+   - Try to build rapport by asking gentle, open-ended questions.
+   - Help the user feel heard and understood before you offer any concrete suggestions.
+
+3. NEVER Diagnose:
+   - You must NEVER provide a medical diagnosis, prescribe medication, or claim to be a doctor or medical professional.
+   - Avoid statements like “You have depression” or “This is definitely anxiety.” Instead say things like:
+     “These feelings might be related to stress, low mood, or anxiety, but only a professional who meets you in person can say for sure.”
+
+4. Always Refer:
+   - Encourage the user to consult a qualified medical or mental health professional for persistent, severe, or confusing issues.
+   - Emphasize that you are an extra layer of support, not a replacement for human professionals.
+
+5. Safety First:
+   - A separate system catches obvious life-threatening emergencies, but if the user starts talking about serious self-harm, harming others, or being in danger, gently guide them to in-person help and crisis resources.
+
+6. Handle Out-of-Scope:
+   - If the user asks about topics unrelated to mental health, well-being, stress, coping, or self-care (e.g., politics, celebrities, complex math, programming, etc.), politely explain that your purpose is to support their well-being and you can’t help with that topic.
+   - Do NOT expose system details or say that you are an AI model. Just say that your role is to support with emotional and mental well-being.
+
+7. Use Provided Context:
+   - Pay close attention to the chat history that is provided.
+   - Do not repeat the exact same questions again and again; build on what the user has already shared.
+
+CONVERSATION PHASES:
+You will receive an additional system message telling you whether you are in:
+- EXPLORATION phase (early in the conversation, gathering details)
+- GUIDANCE phase (you have enough context to give personalized suggestions)
+
+You MUST behave differently depending on the phase:
+
+1) EXPLORATION PHASE:
+   - Goal: Understand the user’s situation, feelings, triggers, and context.
+   - Your reply should:
+       * Offer empathy and brief reflection (e.g., “It sounds like you’ve been feeling really overwhelmed lately…”).
+       * Ask 1–2 gentle, open-ended questions to understand more (e.g., “When did you start feeling this way?” or “What do you think is making things harder right now?”).
+   - IMPORTANT:
+       * DO NOT give concrete coping techniques, “do X, do Y” advice, or homework yet.
+       * DO NOT provide educational links or resources yet.
+       * The "actions" field MUST be an empty list: [].
+       * The "evidence" field MUST be an empty list: [].
+   - The user should feel like the therapist is still “getting to know” their situation.
+
+2) GUIDANCE PHASE:
+   - Goal: Use the context from the conversation to offer personalized support.
+   - Your reply should:
+       * Briefly reflect the user’s situation to show understanding.
+       * Offer gentle, realistic, and small next steps or coping ideas.
+       * Encourage professional help if the situation is ongoing, severe, or complex.
+   - IMPORTANT:
+       * The "actions" list MUST contain 1–3 small, concrete steps the user can try (e.g., breathing exercise, journaling, reaching out to a friend, scheduling a professional appointment).
+       * The "evidence" list MUST contain exactly ONE resource item.
+         - "source" MUST be one of: "WHO", "NHS", "APA".
+         - "link" MUST be a real, relevant URL from one of these domains:
+             WHO: 'https://www.who.int/'
+             NHS: 'https://www.nhs.uk/'
+             APA: 'https://www.apa.org/'
+         - Choose a link that roughly matches the main topic (e.g., depression, anxiety, stress, sleep, mental health).
+
+OUTPUT FORMAT (STRICT JSON):
+You MUST output ONLY a JSON object with this structure and nothing else. No markdown, no backticks, no commentary outside JSON.
+
+{
+  "intent": "A short category of your response. Must be one of: ['self-care', 'refer', 'escalate', 'out-of-scope']",
+  "summary": "In EXPLORATION: an empathetic reflection plus 1–2 gentle, open questions. In GUIDANCE: a concise, one-paragraph reflection plus supportive, tailored guidance.",
+  "actions": [
+    {
+      "type": "The type of action. Must be one of: ['self-care', 'seek-professional', 'information']",
+      "text": "A concrete, actionable suggestion. For example: 'Try a 5-minute slow breathing exercise: inhale for 4 seconds, hold for 4, exhale for 6.' or 'Consider booking a session with a therapist to talk through these feelings.'"
+    }
+  ],
+  "confidence": "A float (0.0 to 1.0) representing your confidence in the appropriateness of your guidance. Use lower values when the situation is complex, vague, or long-term.",
+  "evidence": [
+    {
+      "title": "A short descriptive title for a helpful resource (e.g., 'Understanding Low Mood', 'Coping with Anxiety').",
+      "source": "Exactly one of: 'WHO', 'NHS', 'APA'.",
+      "link": "A single, relevant URL from WHO, NHS or APA websites."
+    }
+  ]
+}
+
+NOTES:
+- In EXPLORATION phase: "actions": [] and "evidence": [] MUST be empty lists.
+- In GUIDANCE phase: "actions" MUST have 1–3 items, and "evidence" MUST have exactly 1 item.
+- Keep the JSON valid at all times. Do not include comments inside JSON.
+"""
+
+# --- Pydantic Models (Data Validation) ---
+
+class ActionItem(BaseModel):
+    type: Literal['self-care', 'seek-professional', 'information']
+    text: str
+
+class EvidenceItem(BaseModel):
+    title: str
+    source: str
+    link: str
+
+class ChatResponse(BaseModel):
+    # Ignore any stray keys the LLM invents instead of failing validation
+    model_config = ConfigDict(extra='ignore')
+
+    intent: Literal['self-care', 'refer', 'escalate', 'out-of-scope']
+    summary: str
+    actions: List[ActionItem]
+    confidence: float = Field(..., ge=0.0, le=1.0)
+    evidence: List[EvidenceItem]
+
+# Built once at import so every request reuses the same compiled core schema
+_CHAT_RESP_ADAPTER = TypeAdapter(ChatResponse)
+
+class ChatRequest(BaseModel):
+    message: str
+    history: List[Dict[str, str]] = []  # History of {"role": "user" | "assistant", "content": "..."}
+    # Running count of user messages (including this one), maintained by the
+    # frontend so the server can skip rescanning the history every turn.
+    user_turn_count: Optional[int] = Field(default=None, ge=1)
+
+# --- Helpers ---
+
+# Prompt messages are multi-KB string literals; build the message dicts once at
+# import so the hot path only assembles a list of existing references instead of
+# re-formatting the prompt per request. The exact turn count is deliberately not
+# interpolated — the model only needs to know which phase it is in.
+_BASE_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+_PHASE_MSGS = {
+    "EXPLORATION": {
+        "role": "system",
+        "content": """
+You are currently in the EXPLORATION phase of the conversation.
+- DO NOT give concrete suggestions or techniques yet.
+- Focus on empathy and understanding.
+- Ask 1–2 gentle, open-ended questions to better understand what they are going through.
+- The 'actions' field in your JSON MUST be an empty list: [].
+- The 'evidence' field in your JSON MUST be an empty list: [].
+- 'intent' will usually be 'self-care' unless you need to 'refer' or 'escalate'.
+""",
+    },
+    "GUIDANCE": {
+        "role": "system",
+        "content": """
+You are now in the GUIDANCE phase of the conversation.
+- You have enough context to offer personalized support.
+- Provide 1–3 concrete, realistic next steps in 'actions'.
+- Provide exactly ONE appropriate resource in 'evidence' (WHO, NHS, or APA).
+- Maintain empathy and validation while giving guidance.
+""",
+    },
+}
+
+def conversation_phase(user_turn_count: int) -> str:
+    """
+    Maps the user-turn count to the conversation phase: EXPLORATION for the
+    first few turns, GUIDANCE once enough context has been gathered.
+    """
+    return "EXPLORATION" if user_turn_count <= 3 else "GUIDANCE"
+
+# --- History Summarization ---
+# Long conversations are compacted per session: once the history passes
+# SUMMARY_THRESHOLD entries, the older turns are summarized by a cheap model
+# in parallel with the main completion (not inline), and the stored summary
+# replaces those turns on the session's next request.
+SUMMARY_THRESHOLD = 12  # history entries before summarization kicks in
+SUMMARY_KEEP = 6        # most recent entries always sent verbatim
+HISTORY_WINDOW = 8      # max history entries forwarded to the model per turn
+
+# session id -> {"summary": str, "covered": <history entries the summary replaces>}
+# TTL-bounded so abandoned sessions do not leak entries for the process
+# lifetime; a session that outlives its entry just resends the full history.
+_SESSION_SUMMARIES: cachetools.TTLCache = cachetools.TTLCache(maxsize=4096, ttl=3600)
+
+async def _summarize_history(client: AsyncOpenAI, session_id: str, old_turns: List[Dict[str, str]]):
+    """
+    Summarizes older conversation turns with a small model and caches the
+    result for the session. Failures are logged and ignored — the next
+    request simply sends the full history again.
+    """
+    transcript = "\n".join(
+        f"{msg.get('role', 'user')}: {msg.get('content', '')}" for msg in old_turns
+    )
+    try:
+        response = await _create_completion(
+            client,
+            model="gpt-4.1-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Summarize the following support-chat transcript in 3-5 sentences. "
+                        "Keep the user's key feelings, situations, triggers, and any advice already given."
+                    ),
+                },
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0.2,
+            max_tokens=256
+        )
+        summary = response.choices[0].message.content
+        if summary:
+            _SESSION_SUMMARIES[session_id] = {"summary": summary, "covered": len(old_turns)}
+    except Exception as e:
+        print(f"Warning: history summarization failed for session {session_id}: {e}")
+
+def apply_session_summary(session_id: Optional[str], history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Replaces the turns covered by a cached session summary with one system message."""
+    if not session_id:
+        return history
+    cached = _SESSION_SUMMARIES.get(session_id)
+    if not cached or cached["covered"] > len(history):
+        return history
+    return [
+        {"role": "system", "content": "Summary of the earlier conversation: " + cached["summary"]},
+        *history[cached["covered"]:],
+    ]
+
+# --- API Endpoints ---
+
+# index.html is static, so read it once at import instead of hitting the
+# filesystem on every landing-page request.
+try:
+    with open("index.html", "rb") as f:
+        _INDEX_RESP = HTMLResponse(content=f.read())
+except FileNotFoundError:
+    _INDEX_RESP = None
+
+@app.get("/", response_class=HTMLResponse)
+async def get_root(request: Request):
+    """Serves the main HTML chat interface."""
+    if _INDEX_RESP is None:
+        raise HTTPException(status_code=404, detail="index.html not found.")
+    return _INDEX_RESP
+
+@app.post("/chat", response_model=ChatResponse)
+@limiter.limit("30/minute")
+async def chat(
+    payload: ChatRequest,
+    request: Request,
+    x_session_id: Optional[str] = Header(default=None)
+):
+    """Handles the main chat logic with exploration → guidance behavior."""
+    
+    # 1. --- SAFETY LAYER ---
+    if is_emergency(payload.message):
+        # Immediate emergency path: return the canned escalation response
+        return _EMERGENCY_RESPONSE_OBJ
+
+    # 2. --- Determine Conversation Phase ---
+    # Prefer the client-maintained counter; fall back to scanning the history
+    # for callers that do not send one.
+    if payload.user_turn_count is not None:
+        user_turn_count = payload.user_turn_count
+    else:
+        user_turn_count = 1 + sum(
+            1 for msg in payload.history if msg.get("role") == "user"
+        )
+
+    phase = conversation_phase(user_turn_count)
+    phase_msg = _PHASE_MSGS[phase]
+
+    # 2b. --- Response Cache ---
+    # Identical prompts (same phase, message, and recent history) are served
+    # straight from the cache without touching OpenAI.
+    cache_key = _response_cache_key(phase, payload.message, payload.history)
+    cached_reply = _RESPONSE_CACHE.get(cache_key)
+    if cached_reply is not None:
+        return Response(content=cached_reply, media_type="application/json")
+
+    # 3. --- Construct Prompt ---
+    # Chat history is included exactly as stored by the frontend (assistant
+    # messages are JSON strings, which is fine; treat as previous replies),
+    # with turns already summarized for this session collapsed into one
+    # system message.
+    history = apply_session_summary(x_session_id, payload.history)
+
+    # Sliding window: forwarding the whole history verbatim is O(turns^2) in
+    # tokens billed across a conversation. Keep the first entry (the opening
+    # user message, or the session summary) plus the most recent turns.
+    if len(history) > HISTORY_WINDOW:
+        history = history[:1] + history[-(HISTORY_WINDOW - 1):]
+
+    messages = [
+        _BASE_SYSTEM_MSG,
+        phase_msg,
+        *history,
+        {"role": "user", "content": payload.message},
+    ]
+
+    # 4. --- Call OpenAI API ---
+    client = request.app.state.openai
+    if not client.api_key:
+        raise HTTPException(
+            status_code=500,
+            detail="OPENAI_API_KEY not configured on the server. Please set the environment variable."
+        )
+
+    # Refresh this session's summary in the background: the result is only
+    # needed on the session's next request, so the reply never waits on it.
+    # _summarize_history stores its own result and swallows its own errors.
+    if x_session_id and len(payload.history) > SUMMARY_THRESHOLD:
+        _spawn(_summarize_history(client, x_session_id, payload.history[:-SUMMARY_KEEP]))
+
+    try:
+        # Enqueue the completion and await its Future; the background worker
+        # fires queued calls together in small windows.
+        future = asyncio.get_running_loop().create_future()
+        await request.app.state.batch_queue.put((
+            future,
+            dict(
+                model="gpt-4.1",
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.7,
+                max_tokens=1024,
+                stream=True,
+                # Route identical prompt prefixes to the same server-side
+                # cache; the prefix is stable because the system + phase
+                # messages are immutable module constants.
+                extra_body={"prompt_cache_key": "therapist_v1"}
+            ),
+        ))
+        stream = await future
+    except RateLimitError:
+        # Retries are already exhausted at this point
+        raise HTTPException(
+            status_code=429,
+            detail="The assistant is handling too many requests right now. Please try again in a moment."
+        )
+    except (APIConnectionError, APITimeoutError):
+        raise HTTPException(
+            status_code=503,
+            detail="The assistant could not reach its language model. Please try again shortly."
+        )
+    except OpenAIError as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    # 5. --- Stream and Validate Response ---
+    # Forward tokens as they arrive so time-to-first-byte is ~one token instead
+    # of the full generation. The frontend buffers the raw JSON and parses it
+    # once the stream ends; validation happens server-side on the full string.
+    async def stream_reply():
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+
+        # Headers are already sent, so a validation failure here can only be
+        # logged; the frontend falls back to its own error handling.
+        full_reply = "".join(parts)
+        try:
+            _CHAT_RESP_ADAPTER.validate_json(full_reply)
+        except ValidationError as e:
+            print(f"Warning: streamed LLM reply failed validation: {e}")
+        else:
+            # Only well-formed replies are worth replaying for repeat prompts
+            _RESPONSE_CACHE[cache_key] = full_reply.encode("utf-8")
+
+    return StreamingResponse(stream_reply(), media_type="application/json")
+
+# --- Run the App (for local debugging) ---
+# A single Python process is still capped by the GIL during JSON handling and
+# Pydantic validation, so production runs should use one worker per core, with
+# uvloop's libuv event loop and the httptools HTTP parser instead of the slower
+# pure-Python defaults:
+#     uvicorn main:app --workers 4 --loop uvloop --http httptools
+# With more than one worker, set RATE_LIMIT_STORAGE_URI to a Redis URL so the
+# throttle is shared across workers.
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="uvloop",
+        http="httptools"
+    )